@@ -1,3 +1,16 @@
-# __init__.py
-
-__version__ = "0.3.1"
+# __init__.py
+
+from .client import (
+    ActionSchema,
+    Context,
+    CreateService,
+    NatsBroker,
+    NatsBrokerPool,
+    current_msg,
+    decode_json,
+    encode_json,
+    prefix_topic,
+    pydantic_validator,
+)
+
+__version__ = "0.3.1"
@@ -1,5 +1,5 @@
 # __main__.py
-import client
+from . import client
 
 
 def main():
@@ -1,9 +1,15 @@
 from __future__ import annotations
 
 import asyncio
-import json
+import concurrent.futures
+import contextvars
+import dataclasses
+import functools
+import os
 import typing
 
+import orjson
+
 import nats
 from nats.aio.client import Client, Msg
 
@@ -12,13 +18,39 @@ nats_client = None
 
 
 class ActionSchema:
-    def __init__(self, name, handle, queue: bool = True, validate=None):
+    __slots__ = ("name", "handle", "queue", "validate", "cpu_bound")
+
+    def __init__(self, name, handle, queue: bool = True, validate=None, cpu_bound: bool = False):
         self.name = name
         self.handle = handle
         self.queue = queue
         self.validate = validate
+        self.cpu_bound = cpu_bound
+
+
+def _pydantic_validate(model, payload):
+    return model.model_validate(payload).model_dump()
+
+
+def pydantic_validator(model):
+    # functools.partial of a module-level function stays picklable, which
+    # cpu_bound validators need to cross into the process pool.
+    return functools.partial(_pydantic_validate, model)
 
 
+@dataclasses.dataclass(frozen=True, slots=True)
+class Context:
+    broker: Client
+    emit: typing.Callable
+    payload: typing.Any = None
+
+    def __getitem__(self, key):
+        # Kept so handlers written against the old dict context
+        # (ctx['payload']) keep working.
+        return getattr(self, key)
+
+
+@functools.lru_cache(maxsize=None)
 def prefix_topic(service_name, service_version, action_name):
     return "v{version}.{name}.{action_name}".format(
         version=service_version,
@@ -27,35 +59,86 @@ def prefix_topic(service_name, service_version, action_name):
     )
 
 
-def encode_json(payload):
-    return json.dumps(payload, default=lambda o: o.__json__()).encode()
+def _default_json_serializer(o):
+    return o.__json__()
+
+
+def encode_json(payload, default=_default_json_serializer, _dumps=orjson.dumps):
+    return _dumps(payload, default=default)
 
 
-def decode_json(payload):
-    return json.loads(payload)
+def decode_json(payload, _loads=orjson.loads):
+    return _loads(payload)
+
+
+def _payload_bytes(payload):
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, str):
+        return payload.encode()
+    return encode_json(payload)
+
+
+_ERROR_PREFIX = b'{"ok":false,"message":'
+
+# The raw Msg being handled, available to action handlers without being
+# copied into every context dict.
+current_msg = contextvars.ContextVar("current_msg", default=None)
 
 
 class NatsBroker:
     nc: Client = None
-    is_done = asyncio.Future()
 
-    def __init__(self, servers: str | list[str] = ["nats://localhost:4222"], token: str = None):
+    def __init__(self, servers: str | list[str] = ["nats://localhost:4222"], token: str = None,
+                 client: Client = None, pending_size: int = 8 * 1024 * 1024,
+                 flusher_queue_size: int = 1024, flush_timeout: float | None = None,
+                 local_dispatch: bool = False, handler_concurrency: int = 0):
         self.servers = servers
         self.token = token
+        self.pending_size = pending_size
+        self.flusher_queue_size = flusher_queue_size
+        self.flush_timeout = flush_timeout
+        self.is_done = None
+        self.nc = client
+        self._emit_fn = self.emit() if client is not None else None
+        self._executor = None
+        self._handler_sem = asyncio.Semaphore(handler_concurrency) if handler_concurrency else None
+        self.local_dispatch = local_dispatch
+        self._local_actions = {}
+        self._connected = client is not None and client.is_connected
 
     async def connect(self):
+        if self.nc is not None and self.nc.is_connected:
+            return self.nc
         try:
+            self.is_done = asyncio.Future()
             self.nc = await nats_server.connect(
-                **{"servers": self.servers, "token": self.token, "closed_cb": self.closed_cb, })
+                **{"servers": self.servers, "token": self.token, "closed_cb": self.closed_cb,
+                   "disconnected_cb": self.disconnected_cb,
+                   "reconnected_cb": self.reconnected_cb,
+                   "pending_size": self.pending_size,
+                   "flusher_queue_size": self.flusher_queue_size,
+                   "flush_timeout": self.flush_timeout, })
+            self._connected = True
 
             global nats_client
             nats_client = self.nc
+            self._emit_fn = self.emit()
         except Exception as e:
             print(e)
+        return self.nc
 
     async def closed_cb(self):
         print('Connection to NATS is closed.')
-        self.is_done.set_result(True)
+        self._connected = False
+        if self.is_done is not None:
+            self.is_done.set_result(True)
+
+    async def disconnected_cb(self):
+        self._connected = False
+
+    async def reconnected_cb(self):
+        self._connected = True
 
     def emit(self):
         ctx = self
@@ -63,10 +146,17 @@ class NatsBroker:
         async def emit_handle(topic, payload, timeout=10000):
             try:
                 ctx.server_is_live()
+                if ctx.local_dispatch:
+                    action = ctx._local_actions.get(topic)
+                    if action is not None:
+                        return await ctx._dispatch_local(action, payload, timeout)
+                # old_style=False keeps all requests on the client's single
+                # muxed _INBOX subscription instead of one inbox per call.
                 m = await ctx.nc.request(
                     subject=topic,
-                    payload=encode_json(payload=payload),
-                    timeout=timeout
+                    payload=_payload_bytes(payload),
+                    timeout=timeout,
+                    old_style=False,
                 )
                 response = decode_json(m.data)
                 if not response['ok']:
@@ -78,68 +168,157 @@ class NatsBroker:
         return emit_handle
 
     async def call(self, topic, payload, timeout=10000):
-        res = await self.emit()(topic, payload, timeout)
+        res = await (self._emit_fn or self.emit())(topic, payload, timeout)
         return res
 
+    async def call_many(self, items, timeout=10000):
+        emit_handle = self._emit_fn or self.emit()
+        return await asyncio.gather(
+            *(emit_handle(topic, payload, timeout) for topic, payload in items))
+
+    async def publish(self, topic, payload):
+        self.server_is_live()
+        await self.nc.publish(subject=topic, payload=_payload_bytes(payload))
+
+    async def publish_many(self, items, flush=True):
+        self.server_is_live()
+        for topic, payload in items:
+            await self.nc.publish(subject=topic, payload=_payload_bytes(payload))
+        if flush:
+            await self.nc.flush()
+
+    async def _dispatch_local(self, action, payload, timeout):
+        # Runs the same steps the remote handler would, so failures surface
+        # like a {"ok": false} reply and a hung handler like a request
+        # timeout. There is no Msg on this path, so current_msg is cleared
+        # rather than left pointing at an earlier delivery.
+        current_msg.set(None)
+        try:
+            if isinstance(payload, (bytes, str)):
+                payload = decode_json(payload)
+            if action.validate:
+                if action.cpu_bound:
+                    payload = await asyncio.get_running_loop().run_in_executor(
+                        self._cpu_pool(), action.validate, payload)
+                else:
+                    payload = action.validate(payload)
+            result = await asyncio.wait_for(action.handle(self._context(payload)), timeout)
+        except asyncio.TimeoutError:
+            raise
+        except Exception as e:
+            raise Exception(str(e))
+        return {"ok": True, "result": result}
+
+    def _cpu_pool(self):
+        # Processes, not threads: a pure-Python validator holds the GIL, so
+        # a thread pool would still stall the event loop for its runtime.
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1)
+        return self._executor
+
     def server_is_live(self):
-        if not self.nc.is_connected:
-            self.closed_cb()
+        # _connected is kept current by the connection callbacks, so the
+        # hot paths check a plain bool instead of the client property.
+        if not self._connected:
+            raise ConnectionError('Connection to NATS is closed.')
 
     async def create_service(self, version, name, workers=1, actions: typing.List[ActionSchema] = []):
         self.server_is_live()
 
+        topics = []
+        tasks = []
         for action in actions:
+            topic_name = prefix_topic(
+                service_name=name,
+                service_version=version,
+                action_name=action.name,
+            )
+            self._local_actions[topic_name] = action
             for i in range(workers):
-                topic_name = prefix_topic(
-                    service_name=name,
-                    service_version=version,
-                    action_name=action.name,
-                )
-                await self.nc.subscribe(
+                topics.append(topic_name)
+                tasks.append(self.nc.subscribe(
                     subject=topic_name,
                     queue="{0}-{1}".format(topic_name, i) if action.queue else None,
                     cb=self._prefix_action(action),
-                )
-                print("[{0}]: Registered topic".format(topic_name))
+                ))
+        await asyncio.gather(*tasks)
+        for topic_name in topics:
+            print("[{0}]: Registered topic".format(topic_name))
 
     def _prefix_action(self, action: ActionSchema):
+        # All per-action branching is resolved here, once per subscription,
+        # so msg_handle only runs the steps this action actually needs.
+        action_suffix = ".{0}".format(action.name)
+        handle = action.handle
+        validate = action.validate if not action.cpu_bound else None
+        cpu_validate = action.validate if action.cpu_bound else None
+        sem = self._handler_sem
+
         async def msg_handle(msg: Msg):
+            reply = msg.reply
             try:
-                subject = msg.subject
-                reply = msg.reply
-                data = msg.data.decode()
-                action_name = subject.split(".")[2]
-                if action_name != action.name:
+                if not msg.subject.endswith(action_suffix):
                     return None
 
-                ctx = self._context()
-                ctx['payload'] = decode_json(data)
-
-                if action.validate:
-                    ctx['payload'] = action.validate(**decode_json(data)).dict()
-
-                result = await action.handle(ctx)
-
-                if len(reply):
+                payload = decode_json(msg.data)
+                if validate is not None:
+                    payload = validate(payload)
+                elif cpu_validate is not None:
+                    payload = await asyncio.get_running_loop().run_in_executor(
+                        self._cpu_pool(), cpu_validate, payload)
+
+                ctx = self._context(payload)
+                current_msg.set(msg)
+                if sem is None:
+                    result = await handle(ctx)
+                else:
+                    async with sem:
+                        result = await handle(ctx)
+                if reply:
                     await msg.respond(encode_json({"ok": True, "result": result}))
             except Exception as e:
-                if len(msg.reply):
-                    await msg.respond(encode_json({"ok": False, "message": str(e)}))
+                if reply:
+                    await msg.respond(_ERROR_PREFIX + encode_json(str(e)) + b"}")
                 print(e)
 
         return msg_handle
 
-    def _context(self):
-        return {
-            "broker": self.nc,
-            "emit": self.emit(),
-        }
+    def _context(self, payload=None):
+        return Context(self.nc, self._emit_fn, payload)
+
+
+class NatsBrokerPool:
+    def __init__(self, servers: str | list[str] = ["nats://localhost:4222"], token: str = None,
+                 size: int = 2):
+        self.brokers = [NatsBroker(servers=servers, token=token) for _ in range(size)]
+        self._next = 0
+
+    async def connect(self):
+        await asyncio.gather(*(broker.connect() for broker in self.brokers))
+        return self
+
+    def broker(self):
+        broker = self.brokers[self._next]
+        self._next = (self._next + 1) % len(self.brokers)
+        return broker
+
+    async def publish(self, topic, payload):
+        await self.broker().publish(topic, payload)
+
+    async def publish_many(self, items, flush=True):
+        await self.broker().publish_many(items, flush=flush)
+
+    async def call(self, topic, payload, timeout=10000):
+        return await self.broker().call(topic, payload, timeout)
 
 
 class CreateService:
-    version: str = '1'
+    __slots__ = ("version", "name", "workers", "actions")
+
+    version: str
     name: str
-    workers: int = 1
+    workers: int
     actions: list[ActionSchema]
 
     def __init__(self, version, name, workers):
@@ -160,5 +339,5 @@ class CreateService:
             name=self.name,
             version=self.version,
             workers=self.workers,
-            actions=self.actions,
+            actions=tuple(self.actions),
         )
@@ -1,9 +1,14 @@
-from setuptools import setup
-
-# Metadata goes in pyproject.toml.
-# These are here for GitHub's dependency graph.
-setup(
-    name="nats-client-py",
-    version="0.3.1",
-    includepackagedata=True,
-)
+from setuptools import setup
+
+setup(
+    name="nats-client-py",
+    version="0.3.1",
+    packages=["nats_client_py"],
+    package_dir={"nats_client_py": "."},
+    include_package_data=True,
+    python_requires=">=3.10",
+    install_requires=[
+        "nats-py==2.2.0",
+        "orjson",
+    ],
+)